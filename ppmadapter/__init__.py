@@ -21,21 +21,29 @@
 # You should have received a copy of the GNU General Public License
 # along with PPMAdapter.  If not, see <http://www.gnu.org/licenses/>.
 
-import array
 import sys
 import pyaudio
 import argparse
-import collections
+import functools
 
 from evdev import UInput, ecodes
 from ctypes import CFUNCTYPE, c_char_p, c_int, cdll
 from contextlib import contextmanager
 
+import numpy as np
+
 try:
-    import numpy as np
     import matplotlib.pyplot as plt
 except ImportError:
-    print("Warning: without numpy and matplotlib, --plot option will not work")
+    print("Warning: without matplotlib, --plot option will not work")
+
+try:
+    from numba import njit
+except ImportError:
+    print("Warning: without numba, decoding will be much slower")
+
+    def njit(*args, **kwargs):
+        return lambda f: f
 
 
 # Suppress ALSA errors
@@ -58,6 +66,86 @@ def noalsaerr():
     asound.snd_lib_error_set_handler(None)
 
 
+@njit(cache=True, boundscheck=False, fastmath={'contract'})
+def _scan(samples, min_value, max_value, previous_value, rate, edges,
+        thresholds, trigger_offsets):
+    """Finds the rising edges of a window in a single pass over it.
+
+    The index, threshold and trigger offset of each edge are written to the
+    given arrays, which must be as long as the window. Returns the updated
+    extrema and previous value, along with the number of edges found.
+    """
+    n = 0
+    for i in range(len(samples)):
+        # Hmm... maybe the problem was just that it needed to be negated?
+        # This is what txppm does.
+        current_value = -np.float32(samples[i])
+
+        # Update extrema and threshold as a weighted average. In my case,
+        # average ends up being close to 0, which then results in noise
+        # triggering this. Thus, weight toward max.
+        if current_value < min_value:
+            min_value = current_value
+        if current_value > max_value:
+            max_value = current_value
+        threshold = np.float32(1/4)*min_value + np.float32(3/4)*max_value
+
+        # Detect rising edge: if the previous value is low and now it's high.
+        # Evaluate both comparisons rather than short-circuiting, so there's
+        # only a branch on the (rare) result.
+        rising = (previous_value < threshold) & (current_value > threshold)
+
+        if rising:
+            # Time when hitting threshold (measured in seconds)
+            # See: https://github.com/nexx512/txppm/blob/master/software/ppm.c
+            edges[n] = i
+            thresholds[n] = threshold
+            trigger_offsets[n] = (threshold - previous_value) / \
+                (current_value - previous_value) / rate
+            n += 1
+
+        previous_value = current_value
+
+    return min_value, max_value, previous_value, n
+
+
+@njit(cache=True, boundscheck=False, fastmath={'contract'})
+def _feed_kernel(edges, trigger_offsets, pulse_start_sample, channel,
+        pulse_start_time, start_pulse_length, rate):
+    """Runs the pulse state machine over the rising edges of a window.
+
+    Returns the updated state, along with the channel each edge measured
+    (-1 for a start pulse) and the value of that channel.
+    """
+    channels = np.empty(len(edges), dtype=np.int64)
+    values = np.zeros(len(edges), dtype=np.float64)
+
+    for k in range(len(edges)):
+        trigger_offset = trigger_offsets[k]
+        trigger_time = (edges[k] - pulse_start_sample) / rate + trigger_offset
+        pulse_length = trigger_time - pulse_start_time
+        pulse_start_time = trigger_time
+
+        # Start pulse
+        if pulse_length > start_pulse_length:
+            channel = 0
+            pulse_start_time = trigger_offset
+            pulse_start_sample = edges[k]
+            channels[k] = -1
+
+        # Channel measurement. Note: still need to increment the channel even
+        # if it isn't mapped since we might care about non-consecutive
+        # channels (e.g. 1, 3, and 5).
+        else:
+            # txppm says "According to the spec, the pulse length ranges from
+            # 1..2ms"
+            channels[k] = channel
+            values[k] = pulse_length*1000 - 1.5
+            channel += 1
+
+    return pulse_start_sample, channel, pulse_start_time, channels, values
+
+
 class PPMDecoder(object):
     """Decodes the audio data into PPM pulse data, and then into uinput
     joystick events.
@@ -69,17 +157,20 @@ class PPMDecoder(object):
         rate : int
             sample rate
         average_length : int
-            average of past channel values for smoothing, set to 1 if undesired
+            number of past channel values to smooth over, set to 1 if undesired
         """
-        self.rate = float(rate)
+        # Sample values and thresholds are float32, which is plenty for 16-bit
+        # samples. Pulse timing stays float64 since sub-sample offsets are
+        # accumulated into it.
+        self.rate = np.float32(rate)
 
         # Values that persist between windows so we can handle small windows
         # where not all the channels have been seen in a single window
-        self.min_value = float("+inf")
-        self.max_value = float("-inf")
+        self.min_value = np.float32("+inf")
+        self.max_value = np.float32("-inf")
         self.channel = 0
         self.previous_value = None
-        self.pulse_start_time = 0
+        self.pulse_start_time = 0.0
         self.samples_since_pulse = 0
 
         # Should be 2ms, but sometimes not quite
@@ -95,9 +186,20 @@ class PPMDecoder(object):
             5: ecodes.ABS_MISC,
         }
 
-        # History of values (for averaging)
-        self.history = {i: collections.deque(maxlen=average_length)
-                for i in self.mapping.keys()}
+        # Same mapping as an array indexed by channel, which must be
+        # consecutive from 0
+        self._mapping_arr = np.array(
+            [self.mapping[i] for i in range(len(self.mapping))], dtype=np.int32)
+
+        # Last value sent per channel, so unchanged ones aren't sent again
+        self._last_sent = np.full(len(self._mapping_arr),
+            np.iinfo(np.int32).min, dtype=np.int32)
+
+        # Exponential moving average of each channel's values (for
+        # smoothing), which tracks about as quickly as an average over the
+        # last average_length values
+        self._ema = np.zeros(len(self._mapping_arr), dtype=np.float32)
+        self._ema_alpha = np.float32(2.0 / (average_length + 1))
 
         # Min/max values we'll output
         events = [(v, (0, -512, 512, 0, 0)) for v in self.mapping.values()]
@@ -107,111 +209,145 @@ class PPMDecoder(object):
             ecodes.EV_KEY: {288: 'BTN_JOYSTICK'}
         })
 
+        # Bound once here since they're used for every update
+        self._ev_abs = ecodes.EV_ABS
+        self._write = self.ev.write
+        self._syn = self.ev.syn
+
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, tb):
         self.ev.close()
 
-    def feed(self, data, plot=False, debug=False):
+    def _decode(self, data):
+        """Decodes a block of sample data, folding the channel values seen
+        into their moving averages.
+
+        Returns the samples, the indices of the rising edges, the threshold
+        at each edge and the channel each edge measured (-1 for a start
+        pulse).
+        """
+        samples = np.frombuffer(data, dtype=np.int16)
+
+        if len(samples) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return samples, empty, np.empty(0, dtype=np.float32), empty
+
+        # Keep track of the previous value for determining if between the
+        # last sample and the current sample there was a rise. The very first
+        # sample we ever see only initialises it.
+        first = 0
+        if self.previous_value is None:
+            self.previous_value = -np.float32(samples[0])
+            first = 1
+
+        # A window can have at most one edge per sample
+        edges = np.empty(len(samples), dtype=np.int64)
+        thresholds = np.empty(len(samples), dtype=np.float32)
+        trigger_offsets = np.empty(len(samples), dtype=np.float32)
+
+        min_value, max_value, previous_value, n = _scan(
+            samples, self.min_value, self.max_value, self.previous_value,
+            self.rate, edges, thresholds, trigger_offsets)
+
+        # Numba hands scalars back as Python floats, so convert them back to
+        # keep _scan specialised for float32
+        self.min_value = np.float32(min_value)
+        self.max_value = np.float32(max_value)
+        self.previous_value = np.float32(previous_value)
+        edges = edges[:n]
+        thresholds = thresholds[:n]
+        trigger_offsets = trigger_offsets[:n]
+
+        # Only the few rising edges need the pulse state machine.
+        # samples_since_pulse is passed as the index (relative to this
+        # window) of the sample where it was last zero.
+        pulse_start_sample, self.channel, self.pulse_start_time, channels, \
+            values = _feed_kernel(edges, trigger_offsets,
+                first - self.samples_since_pulse, self.channel,
+                self.pulse_start_time, self.start_pulse_length, self.rate)
+
+        # If a channel we care about, save it. To enable averaging, fold the
+        # current value into the average but don't set it yet.
+        mapped = (channels >= 0) & (channels < len(self._mapping_arr))
+        ema = self._ema
+        alpha = self._ema_alpha
+        for ch, value in zip(channels[mapped], values[mapped]):
+            ema[ch] = alpha*value + (1 - alpha)*ema[ch]
+
+        self.samples_since_pulse = len(samples) - pulse_start_sample
+
+        return samples, edges, thresholds, channels
+
+    def _send(self, debug=False):
+        """Sends the averaged channel values that changed as joystick
+        updates."""
+        ema = self._ema
+        ev_abs = self._ev_abs
+        write = self._write
+        mapping_arr = self._mapping_arr
+        last_sent = self._last_sent
+        dirty = False
+        for ch in range(len(mapping_arr)):
+            value = int(ema[ch] * 512)
+
+            if value != last_sent[ch]:
+                write(ev_abs, mapping_arr[ch], value)
+                last_sent[ch] = value
+                dirty = True
+
+            if debug:
+                print("ch"+str(ch), "=", value)
+
+        if dirty:
+            self._syn()
+
+    def feed(self, data):
         """Feeds the decoder with a block of sample data.
 
         The data should be integer values, and should only be a single channel.
 
         Parameters
         ----------
-        data : list
-            Sample data
-        plot : bool
-            Whether to display data in a matplotlib plot or not
+        data : bytes
+            Sample data as raw signed 16-bit integers, as read from the stream
         """
-        if plot:
-            plot_start = np.zeros((len(data),))
-            plot_channels = {i: np.zeros((len(data),)) for i in self.mapping.keys()}
-
-        # Process all audio samples
-        for i in range(len(data)):
-            # Hmm... maybe the problem was just that it needed to be negated?
-            # This is what txppm does.
-            current_value = -data[i]
-
-            # Update extrema and threshold as a weighted average. In my case,
-            # average ends up being close to 0, which then results in noise
-            # triggering this. Thus, weight toward max.
-            self.min_value = min(self.min_value, current_value)
-            self.max_value = max(self.max_value, current_value)
-            threshold = 1/4*self.min_value + 3/4*self.max_value
-
-            # Keep track of the previous value for determining if between the
-            # last sample and the current sample there was a rise
-            if self.previous_value is None:
-                self.previous_value = current_value
-                continue
-
-            # Detect rising edge: if the previous value is low and now it's
-            # high
-            rising = self.previous_value < threshold and current_value > threshold
-
-            if rising:
-                # Time when hitting threshold (measured in seconds)
-                # See: https://github.com/nexx512/txppm/blob/master/software/ppm.c
-                trigger_offset = (threshold - self.previous_value) / \
-                    (current_value - self.previous_value) / self.rate
-                trigger_time = self.samples_since_pulse / self.rate + trigger_offset
-                pulse_length = trigger_time - self.pulse_start_time
-                self.pulse_start_time = trigger_time
-
-                # Start pulse
-                if pulse_length > self.start_pulse_length:
-                    self.channel = 0
-                    self.pulse_start_time = trigger_offset
-                    self.samples_since_pulse = 0
-
-                    if plot:
-                        plot_start[i] = threshold
-
-                # Channel measurement
-                else:
-                    # If a channel we care about, save it. Note: still need to
-                    # increment the channel even if not in mapping since we
-                    # might care about non-consecutive channels (e.g. 1, 3, and
-                    # 5).
-                    if self.channel in self.mapping:
-                        # txppm says "According to the spec, the pulse length
-                        # ranges from 1..2ms"
-                        value = pulse_length*1000 - 1.5
-
-                        # To enable averaging, add current value to queue but
-                        # don't set it yet
-                        self.history[self.channel].append(value)
-
-                        if plot:
-                            plot_channels[self.channel][i] = threshold
-
-                    self.channel += 1
-
-            self.samples_since_pulse += 1
-            self.previous_value = current_value
-
-        # Send joystick updates
-        for ch, values in self.history.items():
-            value = 0
-
-            # Handle averaging
-            if len(values) > 0:
-                value = int(sum(values)/len(values) * 512)
-
-            self.ev.write(ecodes.EV_ABS, self.mapping[ch], value)
+        self._decode(data)
+        self._send()
 
-            if debug:
-                print("ch"+str(ch), "=", value)
+    def feed_debug(self, data, plot=False, debug=False):
+        """Same as `feed`, but can also plot and print what was decoded.
 
-        self.ev.syn()
+        Parameters
+        ----------
+        data : bytes
+            Sample data as raw signed 16-bit integers, as read from the stream
+        plot : bool
+            Whether to display data in a matplotlib plot or not
+        debug : bool
+            Whether to print the channel values sent
+        """
+        samples, edges, thresholds, channels = self._decode(data)
+        self._send(debug)
 
         # Plot the audio data we received if desired
         if plot:
-            # Plot negative since we negate when processing
-            y = -np.array(list(data), dtype=np.float32)
+            # Mark the threshold where each start pulse and channel we care
+            # about was detected
+            plot_start = np.zeros((len(samples),))
+            starts = channels == -1
+            plot_start[edges[starts]] = thresholds[starts]
+
+            plot_channels = {}
+            for ch in self.mapping.keys():
+                plot_channels[ch] = np.zeros((len(samples),))
+                measured = channels == ch
+                plot_channels[ch][edges[measured]] = thresholds[measured]
+
+            # Plot negative since we negate when processing. Reuse the samples
+            # already decoded, converting first so -32768 doesn't overflow.
+            y = -samples.astype(np.float32)
             x = np.arange(0, len(y), 1)
             plt.plot(x, y, label="signal")
             plt.plot(x, plot_start, label="start")
@@ -236,8 +372,8 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', help="input audio device name", default='default')
     parser.add_argument('action', default='run', choices=['run', 'inputs'])
-    parser.add_argument('--average', help="average channel values for smoothing (1 = no averaging)", type=int, default=1)
-    parser.add_argument('--buffer', help="buffer size (smaller = lower latency)", type=int, default=64)
+    parser.add_argument('--average', help="smooth channel values over about this many pulses (1 = no smoothing)", type=int, default=1)
+    parser.add_argument('--buffer', help="buffer size (smaller = lower latency)", type=int, default=1024)
     parser.add_argument('--plot', help="display plot of PPM data", dest='plot', action='store_true')
     parser.add_argument('--debug', help="print debug information", dest='debug', action='store_true')
     parser.set_defaults(plot=False, debug=False)
@@ -276,15 +412,21 @@ def main():
                     channels=1,
                     rate=rate,
                     input=True,
-                    frames_per_buffer=chunk*2,
+                    frames_per_buffer=chunk,
                     input_device_index=in_ix)
 
     try:
         with PPMDecoder(rate, args.average) as ppm:
+            # Only take the slower path when plotting or debugging
+            if args.plot or args.debug:
+                feed = functools.partial(ppm.feed_debug, plot=args.plot,
+                    debug=args.debug)
+            else:
+                feed = ppm.feed
+
             while True:
-                sample = stream.read(chunk)
-                sample = array.array('h', sample)
-                ppm.feed(sample, args.plot, args.debug)
+                raw = stream.read(chunk, exception_on_overflow=False)
+                feed(raw)
     finally:
         stream.close()
 